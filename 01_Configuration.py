@@ -22,13 +22,20 @@ config['incoming_image_file_path'] = config['mount_point'] + 'tmp/incoming_image
 config['checkpoint_path'] = config['mount_point'] + 'tmp/image_processing_chkpnt/' # folder where incoming image processing checkpoint resides
 config['checkpoint_path_inference'] = config['mount_point'] + 'tmp/image_inference_chkpnt/'
 config['checkpoint_path_inference_73'] = config['mount_point'] + 'tmp/image_inference_chkpnt_73/'
+config['use_file_notifications'] = False # set to True to discover incoming images through cloud storage events; requires a cloud storage path (not /tmp) and permissions to create the notification queue
 config['petastorm_path'] = 'file:///dbfs/tmp/petastorm/cache' # location where to store petastorm cache files
 config['input_images_table'] = 'cv.images'
+config['image_content_table'] = 'cv.image_content'
 config['scored_images_73_table'] = "cv.scored_images_73"
 config['scored_images_table'] = "cv.scored_images"
 
 # COMMAND ----------
 
+# DBTITLE 1,Image Processing Settings
+config['full_res_stats'] = False # set to True to calculate image statistics from full-resolution pixels instead of a faster, 1/4-scale decode
+
+# COMMAND ----------
+
 # DBTITLE 1,Model Settings
 config['tuning_model_name'] = 'cv pytorch tuning'
 config['tuned_model_name'] = 'cv pytorch tuned'
@@ -17,8 +17,21 @@
 import pyspark.sql.functions as f
 from pyspark.sql.types import *
 
-import io
-from PIL import Image, ImageStat, ExifTags
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+import numba
+from numba import njit, prange
+import numpy as np
+import pyarrow as pa
+from pyspark.sql.pandas.types import to_arrow_type
+from PIL import Image, ExifTags
+
+# nvidia dali and cupy are only needed (and typically only installed) on gpu clusters
+try:
+  from nvidia.dali import Pipeline, fn as dali_fn, types as dali_types
+  import cupy as cp
+except ImportError:
+  cp = None
 
 # COMMAND ----------
 
@@ -59,25 +72,31 @@ spark.sql(f"""create database if not exists cv location '{config['database_root'
 # COMMAND ----------
 
 # DBTITLE 1,Read Incoming Image Files
-# set processing limit for reading files
+# set processing limits for reading files
 max_bytes_per_executor = 512 * 1024**2 # 512-MB limit
+max_files_per_executor = 2000 # 2,000-file limit
 
 # define stream
 incoming_images = (
   spark
     .readStream
     .format('cloudFiles')  # auto loader
-    .option('cloudFiles.format', 'binaryFile') # read as binary image
-    .option('recursiveFileLookup', 'true') # search subfolders (if any)
+    .option('cloudFiles.format', 'binaryFile') # read as binary image; this format's schema is fixed so no schema inference is performed
+    .option('recursiveFileLookup', 'true') # search subfolders (if any), without inferring partition columns from their names
     .option('cloudFiles.includeExistingFiles', 'true') # allows complete restarts, otherwise will only read newly arrived files
     .option('pathGlobFilter', '*.jpg') # limit to JPG files
+    .option('cloudFiles.useNotifications', config['use_file_notifications']) # discover new files through storage events instead of directory listings
+    .option('cloudFiles.fetchParallelism', sc.defaultParallelism) # threads used to fetch file events from the notification queue
+    .option('cloudFiles.maxFilesPerTrigger', sc.defaultParallelism * max_files_per_executor) # limit file counts processed per cycle
     .option('cloudFiles.maxBytesPerTrigger', sc.defaultParallelism * max_bytes_per_executor) # limit data volumes processed per cycle
     .load(config['incoming_image_file_path']) # location to read from
   )
 
 # COMMAND ----------
 
-# MAGIC %md The setup of our Auto Loader functionality is pretty straight-forward.  We point Spark to our cloud storage location and limit access to files with names aligned with a provided glob.  The *cloudFiles.maxBytesPerTrigger* option is intended to protect our cluster from being overwhelmed by a surge in files that could occur if a device becomes backlogged and then transmits an exceptionally large volume of files to storage in a single burst.  With our images consisting of about 0.3 megapixels and being compressed in the JPG format, each image is roughly 220 KB in size.  The *maxBytesPerTrigger* setting will allow us to process a couple thousand images at a time with each worker core.  Additional options for the configuration of Auto Loader can be found [here](https://docs.databricks.com/spark/latest/structured-streaming/auto-loader-gen2.html#common-auto-loader-options).
+# MAGIC %md The setup of our Auto Loader functionality is pretty straight-forward.  We point Spark to our cloud storage location and limit access to files with names aligned with a provided glob.  The *cloudFiles.maxBytesPerTrigger* option is intended to protect our cluster from being overwhelmed by a surge in files that could occur if a device becomes backlogged and then transmits an exceptionally large volume of files to storage in a single burst.  With our images consisting of about 0.3 megapixels and being compressed in the JPG format, each image is roughly 220 KB in size.  The *maxBytesPerTrigger* setting will allow us to process a couple thousand images at a time with each worker core.  The *cloudFiles.maxFilesPerTrigger* option places a similar limit on the number of files in each cycle so that a burst of files doesn't leave the stream spending its time planning a very large batch.
+# MAGIC 
+# MAGIC By default, Auto Loader discovers new files by listing the storage location on each cycle.  With a large number of files, these listings can become a bottleneck.  If you've pointed this notebook at a cloud storage location and have the permissions required to set up [file notifications](https://docs.databricks.com/ingestion/auto-loader/file-detection-modes.html), set *use_file_notifications* to *True* in the configuration notebook so that Auto Loader instead reads file events from a queue, using *cloudFiles.fetchParallelism* threads to do so.  Because each image is a small object, much of the time spent reading it is spent waiting on requests to cloud storage.  The clusters defined in the *RUNME* notebook therefore configure the S3 and ADLS connectors to read each object in a single sequential request and to keep more connections open in parallel.  Additional options for the configuration of Auto Loader can be found [here](https://docs.databricks.com/spark/latest/structured-streaming/auto-loader-gen2.html#common-auto-loader-options).
 
 # COMMAND ----------
 
@@ -85,108 +104,75 @@ incoming_images = (
 # MAGIC 
 # MAGIC The name assigned each incoming image file captures the local date and time an image was taken as well as the ID of the device taking it.  In addition, the file name includes a pre-assigned label indicating whether or not the image includes an object of interest, *i.e.* a package placed near the front porch on which the device has been mounted.  (Typically, images would not arrive pre-labeled.  We will revisit image labeling in another series of notebooks.)
 # MAGIC 
-# MAGIC To extract this information, we can call a few string parsing functions as follows:
+# MAGIC To extract this information, we can match the file name against a regular expression, extracting each piece of information from its own group.  Images arriving without a numeric label receive a null label while the other pieces of information are still extracted, and files with names that don't match the expected pattern receive null values instead of mis-parsed ones:
 
 # COMMAND ----------
 
 # DBTITLE 1,Parse Data
+# pattern of the <timestamp>_<device id>_<label>.jpg file name at the end of each path; 
+# the label group only captures numeric labels, leaving it empty for unlabeled images such as <timestamp>_<device id>_front.jpg
+file_name_pattern = '(?:^|/)(([^/_]+)_([^/]+)_(?:([0-9]+)|[^/_]+)[.]jpg)$'
+
+def file_name_part(group):
+  '''extract a group from the file name pattern, returning null for paths that don't match it'''
+  return f.expr(f"nullif(regexp_extract(path, '{file_name_pattern}', {group}), '')")
+
 images_with_parsed_data = (
   incoming_images
-    .withColumn('file_name', f.expr("reverse(split(path,'/'))[0]"))
-    .withColumn('timestamp', f.expr("to_timestamp(split(file_name,'_')[0])"))
+    .withColumn('file_name', file_name_part(1))
+    .withColumn('timestamp', f.to_timestamp(file_name_part(2)))
     .withColumn('date', f.expr('to_date(timestamp)'))
-    .withColumn('device_id', f.expr("reverse(split(reverse(split(file_name,'_',2)[1]),'_',2)[1])"))
-    .withColumn('label', f.expr("cast(split(reverse(split(file_name, '[.]')[0]), '_')[0] as int)"))
+    .withColumn('device_id', file_name_part(3))
+    .withColumn('label', file_name_part(4).cast('int'))
     )
 
 # COMMAND ----------
 
 # MAGIC %md ## Step 3: Extract Metadata from Images
 # MAGIC 
-# MAGIC Auto Loader reads each image file as a binary array and places it into the *content* field. This binary data contains not only the pixels that make up the image but also metadata captured by the local device.  This metadata, especially the [Exif data](https://en.wikipedia.org/wiki/Exif), provides information our Data Scientists may use to evaluate the data ahead of a training exercise.  We'll write a function to extract this data so that it may be presented in a more accessible, queryable format:
+# MAGIC Auto Loader reads each image file as a binary array and places it into the *content* field. This binary data contains not only the pixels that make up the image but also metadata captured by the local device.  This metadata, especially the [Exif data](https://en.wikipedia.org/wiki/Exif), provides information our Data Scientists may use to evaluate the data ahead of a training exercise.  We'll write a function to extract this data so that it may be presented in a more accessible, queryable format.  That function, defined in the next step, is applied using [mapInArrow](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.DataFrame.mapInArrow.html) so that images are passed to it in Arrow record batches instead of one row at a time.  This allows the function to read each image's header and Exif data, and on GPU-equipped clusters to feed each image to the GPU's decoder, straight from the batch's buffer without first copying the image's binary.  Opening a JPG with PIL reads only its header segments, including the Exif data, without decoding any pixels, so this metadata is retrieved cheaply; the far more expensive pixel decode is only performed for the statistics calculated in the next step.  We'll start by defining the structure of the metadata our function returns:
 
 # COMMAND ----------
 
 # DBTITLE 1,Define Exif Schema
+# tag id to friendly name lookups, built once for use here and in the extract function
+_TAGS = dict(ExifTags.TAGS)
+_GPSTAGS = dict(ExifTags.GPSTAGS)
+
+# tag ids pointing to the exif and gps sub-directories (ifds)
+_EXIF_IFD = next(k for k, v in _TAGS.items() if v=='ExifOffset')
+_GPS_IFD = next(k for k, v in _TAGS.items() if v=='GPSInfo')
+
 exif_schema = []
+seen = set()
 
 # general exif tags
-for t in ExifTags.TAGS:
+for name in _TAGS.values():
+  
+  if name in seen: continue
+  seen.add(name)
   
-  if ExifTags.TAGS[t]=='GPSInfo':
+  if name=='GPSInfo':
     gps_schema = []
+    gps_seen = set()
     
     # GPSInfo tags
-    for g in ExifTags.GPSTAGS:
-      tag = StructField(ExifTags.GPSTAGS[g], StringType())
-      if tag not in gps_schema: gps_schema += [tag]
+    for gps_name in _GPSTAGS.values():
+      if gps_name in gps_seen: continue
+      gps_seen.add(gps_name)
+      gps_schema += [StructField(gps_name, StringType())]
     
-    tag = StructField(ExifTags.TAGS[t], StructType(gps_schema))
-    if tag not in exif_schema: exif_schema += [tag]
+    exif_schema += [StructField(name, StructType(gps_schema))]
     
   else:
     
-    tag = StructField(ExifTags.TAGS[t], StringType())
-    if tag not in exif_schema: exif_schema += [tag]
+    exif_schema += [StructField(name, StringType())]
     
 exif_schema = StructType(exif_schema)
 
 # COMMAND ----------
 
-# DBTITLE 1,Define Function to Retrieve Image Metadata
-def get_image_metadata_udf(image_binary):
-
-  def _cleanse_exif(exif_with_numerical_keys):
-    '''
-    convert exif from dictionary with numerical keys 
-    to dictionary with friendly string keys
-    '''
-    exif = {}
-    for k, v in exif_with_numerical_keys.items():
-      
-      # make sure value is a string
-      v = str(v)
-      
-      # lookup key names
-      if k in ExifTags.TAGS:
-        key = ExifTags.TAGS[k]
-      else:
-        key = k
-
-      # if that friendly name is GPSInfo, it's value is a nested  
-      # dictionary of other EXIF tags with their own key lookups
-      if key=='GPSInfo':
-        gps = {}
-        for kg, vg in v.items():
-          if kg in ExifTags.GPSTAGS:
-            gps[ExifTags.GPSTAGS[kg]] = str(vg)
-          else:
-            gps[kg] = vg
-        v = gps
-        
-      exif[key] = v
-      
-    return exif
-  
-  # interpret image from binary
-  image = Image.open(io.BytesIO(image_binary))
-    
-  # extract metadata
-  metadata = {}
-  metadata['height'] = image.height
-  metadata['width'] = image.width
-  metadata['dpi_vertical'] = image.info['dpi']
-  metadata['layers'] = image.layers
-  metadata['mode'] = image.mode
-  metadata['format'] = image.format
-  metadata['exif'] = _cleanse_exif(image._getexif())
-
-  return metadata
-  #return {'test': str(metadata)}
-
-# COMMAND ----------
-
-# DBTITLE 1,Register Metadata Extract Function
+# DBTITLE 1,Define Metadata Schema
 # define schema of returned metadata
 metadata_schema =  StructType([
   StructField('height', IntegerType()),
@@ -198,91 +184,334 @@ metadata_schema =  StructType([
   StructField('exif', exif_schema)
   ])
 
-#metadata_schema = StructType([StructField('test', StringType())])
-
-# register function for use with sql
-_ = spark.udf.register('get_image_metadata', get_image_metadata_udf, metadata_schema)
-
-# COMMAND ----------
-
-# DBTITLE 1,Get Metadata
-images_with_metadata = (
-  images_with_parsed_data
-    .withColumn('metadata', f.expr('get_image_metadata(content)'))
-    )
-
 # COMMAND ----------
 
 # MAGIC %md ##Step 4: Calculate Statistics
 # MAGIC 
-# MAGIC In addition to metadata, we might extract various statistics from each image.  Again, we'll do this using a custom function:
+# MAGIC In addition to metadata, we might extract various statistics from each image.  Decoding the JPG is the most expensive part of this work, so rather than write separate functions for the metadata and the statistics, we'll write a single function that derives both from one decode of each image.  That decode is performed by PIL which, as installed from its standard wheels, is built on the SIMD-accelerated [libjpeg-turbo](https://libjpeg-turbo.org/) library.  On GPU-equipped clusters with [NVIDIA DALI](https://docs.nvidia.com/deeplearning/dali/user-guide/docs/installation.html) and [CuPy](https://cupy.dev/) installed, images are instead decoded in batches by the GPU's nvJPEG decoder and their statistics calculated without moving the pixels off of the GPU.
+# MAGIC 
+# MAGIC JPG decoders can also skip much of their work by decoding an image at a fraction of its full resolution.  As the statistics we calculate are used to evaluate our images ahead of training, and not to train the model itself, our decodes are performed at 1/4 scale.  (The GPU's nvJPEG decoder can't decode at a reduced scale, so on GPU-equipped clusters images are decoded at full resolution and then resized to these same reduced dimensions.)  The means calculated this way closely track those of the full-resolution images.  The remaining statistics are approximations: decoding at a reduced scale averages away fine detail and noise, narrowing the standard deviations and extrema somewhat, and the histogram counts the pixels of the reduced image, 1/16th as many as in the original.  Set *full_res_stats* to *True* in the configuration notebook if you need exact, full-resolution statistics.
+# MAGIC 
+# MAGIC The histogram holds 256 pixel counts for each band/layer of an image.  Rather than store these as an array of integers, we store them as a compact binary value holding the counts as little-endian, 32-bit unsigned integers.  To work with a histogram, convert it back to a 2-D array with one row per band/layer using `np.frombuffer(histogram, dtype='<u4').reshape(-1, 256)`:
 
 # COMMAND ----------
 
-# DBTITLE 1,Define Function to Calculate Statistics
-def get_image_statistics_udf(image_binary):  
-
-  # interpret image from binary
-  image = Image.open(io.BytesIO(image_binary))
-
-  # extract stats
-  statistics = {}
-  
-  stat = ImageStat.Stat(image)
-  statistics['mean'] = stat.mean # mean value by band/layer
-  statistics['median'] = stat.median # median value by band/layer
-  statistics['stddev'] = stat.stddev # stdddev by band/layer
-  statistics['extrema'] = stat.extrema  # (min, max) by band/layer
-  statistics['entropy'] = image.entropy() # measure of randomness to pixels
-  statistics['histogram'] = image.histogram() # count of pixels by band-value
-
-  return statistics
-
-# define schema of returned metadata
+# DBTITLE 1,Define Statistics Schema
+# define schema of returned statistics
 statistics_schema =  StructType([
   StructField('mean', ArrayType(DoubleType())), 
   StructField('median', ArrayType(IntegerType())), 
   StructField('stddev', ArrayType(DoubleType())), 
   StructField('extrema', ArrayType(ArrayType(IntegerType()))), 
   StructField('entropy', DoubleType()), 
-  StructField('histogram', ArrayType(IntegerType()))
+  StructField('histogram', BinaryType()) # 256 little-endian uint32 counts per band/layer
   ])
 
-# register function for use with sql
-_ = spark.udf.register('get_image_statistics', get_image_statistics_udf, statistics_schema)
+# COMMAND ----------
+
+# DBTITLE 1,Define Arrow Types of Returned Structs
+def to_nested_arrow_type(data_type):
+  '''
+  convert a spark data type to an arrow type, including structs nested 
+  within structs (such as exif within metadata) which to_arrow_type rejects
+  '''
+  if isinstance(data_type, StructType):
+    return pa.struct([pa.field(field.name, to_nested_arrow_type(field.dataType)) for field in data_type])
+  return to_arrow_type(data_type)
+
+metadata_arrow_type = to_nested_arrow_type(metadata_schema)
+statistics_arrow_type = to_nested_arrow_type(statistics_schema)
 
 # COMMAND ----------
 
-# DBTITLE 1,Get Statistics
-images_with_statistics = (
-  images_with_metadata
-    .withColumn('statistics', f.expr('get_image_statistics(content)'))
-    )
+# DBTITLE 1,Define Function to Count Pixels by Band-Value
+@njit(parallel=True)
+def histogram_kernel(pixels, offsets, bands):
+  '''
+  count pixels by band-value for a batch of images, in parallel across images;
+  each image's interleaved band values are held in pixels[offsets[i]:offsets[i+1]]
+  '''
+  histograms = np.zeros((len(bands), bands.max(), 256), dtype=np.int64)
+  for i in prange(len(bands)):
+    for j in range(offsets[i], offsets[i + 1], bands[i]):
+      for b in range(bands[i]):
+        histograms[i, b, pixels[j + b]] += 1
+  return histograms
+
+# COMMAND ----------
+
+# DBTITLE 1,Define Function to Retrieve Image Metadata & Statistics
+def get_image_info(batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+  '''
+  replace the content field of each batch of images with 
+  structs holding the metadata and statistics of each image
+  '''
+
+  def _cleanse_exif(exif_with_numerical_keys):
+    '''
+    convert exif from pil's Exif object with numerical keys 
+    to dictionary with friendly string keys
+    '''
+    exif = {}
+    
+    # tags in the exif sub-directory are presented alongside the general tags
+    for k, v in {**exif_with_numerical_keys, **exif_with_numerical_keys.get_ifd(_EXIF_IFD)}.items():
+      
+      # GPSInfo's value is a nested dictionary of other 
+      # EXIF tags with their own key lookups
+      if k==_GPS_IFD:
+        gps = exif_with_numerical_keys.get_ifd(_GPS_IFD)
+        exif['GPSInfo'] = {_GPSTAGS[kg]: str(vg) for kg, vg in gps.items() if kg in _GPSTAGS}
+        continue
+      
+      # skip tags unknown to pil as exif_schema holds no field for them
+      if k not in _TAGS: continue
+      
+      # lookup key names and make sure value is a string
+      exif[_TAGS[k]] = str(v)
+      
+    return exif
+  
+  def _draft(image, scale):
+    '''
+    have pil decode an image at (about) 1/scale of its full resolution, 
+    returning the size it will be decoded to
+    '''
+    image.draft(image.mode, (max(1, image.width // scale), max(1, image.height // scale))) # ignored for formats other than jpg; sizes kept above zero for images smaller than the scale
+    return image.size
+  
+  def _histograms_on_cpu(images, scale, batch_size=64, decode_threads=4):
+    '''
+    decode images using pil at 1/scale of their full resolution, 
+    counting their pixels by band-value in parallel batches
+    '''
+    def _decode(image):
+      _draft(image, scale)
+      pixels = np.asarray(image).ravel()
+      image.close() # release the decoded image now its pixels are copied, rather than holding it for the rest of the arrow batch
+      return pixels
+    
+    # pil releases the gil while decoding, allowing a batch's images to be decoded concurrently
+    with ThreadPoolExecutor(max_workers=decode_threads) as pool:
+      for start in range(0, len(images), batch_size):
+        
+        # decode the batch to a single run of pixel values
+        bands = np.array([len(image.getbands()) for image in images[start:start + batch_size]])
+        pixels = list(pool.map(_decode, images[start:start + batch_size]))
+        offsets = np.cumsum([0] + [len(p) for p in pixels])
+        
+        histograms = histogram_kernel(np.concatenate(pixels), offsets, bands)
+        for histogram, b in zip(histograms, bands):
+          yield histogram[:b]
+  
+  def _build_gpu_pipeline(scale, batch_size=256):
+    '''
+    build a nvidia dali pipeline decoding batches of images on the gpu 
+    with nvjpeg and resizing them to 1/scale of their full resolution
+    '''
+    pipe = Pipeline(batch_size=batch_size, num_threads=4, device_id=0, prefetch_queue_depth=1, exec_async=False, exec_pipelined=False)
+    with pipe:
+      jpegs = dali_fn.external_source(name='jpegs', dtype=dali_types.UINT8)
+      decoded = dali_fn.decoders.image(jpegs, device='mixed', output_type=dali_types.ANY_DATA, hw_decoder_load=0.75)
+      
+      # nvjpeg can't decode at a reduced scale, so resize to the dimensions of pil's reduced-scale 
+      # decode, averaging rather than sampling pixels (as that decode does) when shrinking the image
+      if scale > 1:
+        widths = dali_fn.external_source(name='widths', dtype=dali_types.FLOAT)
+        heights = dali_fn.external_source(name='heights', dtype=dali_types.FLOAT)
+        decoded = dali_fn.resize(decoded, resize_x=widths, resize_y=heights, interp_type=dali_types.INTERP_LINEAR, antialias=True)
+      
+      pipe.set_outputs(decoded)
+    pipe.build()
+    return pipe
+  
+  def _histograms_on_gpu(pipe, image_binaries, images, scale):
+    '''
+    decode images in batches with the dali pipeline, counting their 
+    pixels by band-value without moving the pixels off of the gpu
+    '''
+    batch_size = pipe.max_batch_size
+    for start in range(0, len(image_binaries), batch_size):
+      pipe.feed_input('jpegs', [np.frombuffer(b, dtype=np.uint8) for b in image_binaries[start:start + batch_size]])
+      if scale > 1:
+        sizes = [_draft(image, scale) for image in images[start:start + batch_size]] # reads no pixels, only the size pil would decode to
+        pipe.feed_input('widths', [np.float32(w) for w, h in sizes])
+        pipe.feed_input('heights', [np.float32(h) for w, h in sizes])
+      decoded, = pipe.run()
+      for j in range(len(decoded)):
+        pixels = cp.asarray(decoded[j])
+        pixels = pixels.reshape(-1, pixels.shape[-1])
+        yield cp.stack([cp.bincount(pixels[:, b], minlength=256) for b in range(pixels.shape[1])]).get()
+  
+  # unless full resolution is requested, calculate statistics from images at 1/4 scale
+  scale = 1 if config['full_res_stats'] else 4
+  
+  # decode on the gpu if one is available to this worker, building its pipeline once for all batches
+  use_gpu = cp is not None and cp.cuda.is_available()
+  pipe = _build_gpu_pipeline(scale) if use_gpu else None
+  
+  # leave a second core for the histogram kernel while other tasks share the worker
+  numba.set_num_threads(min(2, numba.config.NUMBA_NUM_THREADS))
+  
+  for batch in batches:
+    
+    # locate each image's binary within the batch's content buffer, viewing it in place rather than copying it;
+    # binary columns hold 32-bit offsets and large_binary columns (spark.sql.execution.arrow.useLargeVarTypes) 64-bit ones
+    content = batch.column(batch.schema.get_field_index('content'))
+    assert pa.types.is_binary(content.type) or pa.types.is_large_binary(content.type), f'unexpected content type {content.type}'
+    offset_type = np.int64 if pa.types.is_large_binary(content.type) else np.int32
+    offsets = np.frombuffer(content.buffers()[1], dtype=offset_type)[content.offset:content.offset + len(content) + 1]
+    image_buffers = [content.buffers()[2][start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    image_binaries = [memoryview(b) for b in image_buffers]
+    
+    # preallocate a list of values for each field in the batch
+    info = {field.name: [None] * batch.num_rows for field in metadata_schema.fields + statistics_schema.fields}
+    images = [None] * batch.num_rows
+    
+    for i, image_buffer in enumerate(image_buffers):
+      
+      # interpret image from binary (only the header is read at this point)
+      image = images[i] = Image.open(pa.BufferReader(image_buffer))
+      
+      # extract metadata
+      info['height'][i] = image.height
+      info['width'][i] = image.width
+      info['dpi'][i] = [int(d) for d in image.info['dpi']] if 'dpi' in image.info else None
+      info['layers'][i] = image.layers
+      info['mode'][i] = image.mode
+      info['format'][i] = image.format
+      info['exif'][i] = _cleanse_exif(image.getexif())
+    
+    # decode pixels just once, counting them by band-value in the only pass made over them
+    histograms = _histograms_on_gpu(pipe, image_binaries, images, scale) if use_gpu else _histograms_on_cpu(images, scale)
+    
+    for i, histogram in enumerate(histograms):
+      
+      # derive stats from the histogram
+      values = np.arange(256)
+      count = histogram.sum(axis=1)
+      mean = (histogram * values).sum(axis=1) / count
+      observed = histogram > 0
+      p = histogram[observed] / histogram.sum()
+      info['mean'][i] = mean.tolist() # mean value by band/layer
+      info['median'][i] = np.argmax(histogram.cumsum(axis=1) > count[:, None] // 2, axis=1).tolist() # median value by band/layer
+      info['stddev'][i] = np.sqrt((histogram * (values - mean[:, None])**2).sum(axis=1) / count).tolist() # stdddev by band/layer
+      info['extrema'][i] = np.stack([np.argmax(observed, axis=1), 255 - np.argmax(observed[:, ::-1], axis=1)], axis=1).tolist()  # (min, max) by band/layer
+      info['entropy'][i] = float(-(p * np.log2(p)).sum()) # measure of randomness to pixels
+      info['histogram'][i] = histogram.astype('<u4').tobytes() # count of pixels by band-value
+    
+    # return all fields but content, which is persisted separately
+    names = [name for name in batch.schema.names if name!='content']
+    metadata, statistics = [
+      pa.StructArray.from_arrays([pa.array(info[field.name], type=field.type) for field in arrow_type], fields=list(arrow_type))
+      for arrow_type in (metadata_arrow_type, statistics_arrow_type)
+      ]
+    yield pa.RecordBatch.from_arrays([batch.column(name) for name in names] + [metadata, statistics], names=names + ['metadata', 'statistics'])
+
+# COMMAND ----------
+
+# DBTITLE 1,Configure Arrow
+# limit the rows in each arrow batch passed to our function, bounding the number of images held by each python worker
+spark.conf.set('spark.sql.execution.arrow.maxRecordsPerBatch', 512)
+
+# COMMAND ----------
+
+# DBTITLE 1,Get Metadata & Statistics
+# define schema of returned batches
+images_with_info_schema = StructType(
+  [field for field in images_with_parsed_data.schema if field.name!='content'] + 
+  [StructField('metadata', metadata_schema), StructField('statistics', statistics_schema)]
+  )
+
+def with_image_info(images):
+  '''
+  replace the content field of a dataframe of parsed images 
+  with metadata and statistics fields derived from it
+  '''
+  return images.mapInArrow(get_image_info, images_with_info_schema)
+
+# verify the function is evaluated over arrow batches (PythonMapInArrow)
+images_with_parsed_data.transform(with_image_info).explain()
+
+# report the decoder our function will select, checking for a gpu on a worker rather than the driver
+use_gpu = sc.parallelize([0], 1).map(lambda _: cp is not None and cp.cuda.is_available()).first()
+print(f"Decoding images with {'nvJPEG (DALI) on the GPU' if use_gpu else 'PIL (libjpeg-turbo) on the CPU'}")
 
 # COMMAND ----------
 
 # MAGIC %md ## Step 5: Persist to Delta
 # MAGIC 
-# MAGIC With metadata and statistics extracted, we can now persist these data to a queryable table.  We'll make use of the Delta Lake format as it supports a wide range of data modification capabilities and allows us to recognize incremental changes to the data that might be useful in some downstream scenarios. This table will serve as a the focal point for model training work taking place in the next notebook:
+# MAGIC With metadata and statistics extracted, we can now persist these data to a queryable table.  We'll make use of the Delta Lake format as it supports a wide range of data modification capabilities and allows us to recognize incremental changes to the data that might be useful in some downstream scenarios. This table will serve as a the focal point for model training work taking place in the next notebook.  We partition the table by date and device so that work focused on the images from a given device, such as the training of a device-specific model, only reads the files for that device.  (With thousands of devices, partitioning on a hash of the device ID bucketed into a small number of values would avoid an excess of small partitions.)  Once loaded, the files within each partition are sorted by time using a [Z-ORDER](https://docs.databricks.com/delta/data-skipping.html) optimization so that queries over a window of time read fewer files.
 # MAGIC 
-# MAGIC **NOTE** If you wish to reset the cv.images table, please delete the files found in the checkpoint path before restarting the stream. Otherwise, the prior state of the stream ahead of the write to the cv.image table will be preserved.  These actions are performed at the top of this notebook.
+# MAGIC You may have noticed that our function left the *content* field out of the data it returns.  At roughly 220 KB per image, the raw binary is many times larger than the metadata and statistics we've extracted, and keeping it in the images table would mean every query against that table would need to read past it.  Instead, we persist the binaries to a separate table which we can join back to the images table on the *path* field when we need the pixels themselves, as we will when training our model.
+# MAGIC 
+# MAGIC Both tables are written from a single stream using [foreachBatch](https://docs.databricks.com/structured-streaming/foreach.html).  Each micro-batch of images is read from storage just once and cached, and its binaries and its metadata and statistics are then written from that same cached data.  As the two writes share a single checkpoint, a cycle is only marked complete once both tables hold its images, and the transaction identifiers passed with each write allow a failed cycle to be retried without duplicating the images already written to either table:
+# MAGIC 
+# MAGIC **NOTE** If you wish to reset the cv.images and cv.image_content tables, please delete the files found in the checkpoint path and drop the tables before restarting the stream. Otherwise, the prior state of the stream ahead of the writes to these tables will be preserved.  These actions are performed at the top of this notebook.
 
 # COMMAND ----------
 
-# DBTITLE 1,Persist Data to Images Table
-_ = (
-  images_with_statistics
+# DBTITLE 1,Persist Data to Images & Image Content Tables
+# coalesce the small files written with each cycle into fewer, larger files
+spark.conf.set('spark.databricks.delta.optimizeWrite.enabled', 'true')
+spark.conf.set('spark.databricks.delta.autoCompact.enabled', 'true')
+
+def persist_images(images, batch_id):
+  '''
+  write a micro-batch of parsed images to the image content table 
+  and, with their metadata and statistics, to the images table
+  '''
+  # read each image from storage just once for both writes
+  images.persist()
+  
+  (
+    images
+      .select('path', 'date', 'content')
+      .write
+      .format('delta')
+      .mode('append')
+      .option('txnAppId', 'cv_image_content') # skip this write if a retried cycle already committed it
+      .option('txnVersion', batch_id)
+      .partitionBy('date')
+      .saveAsTable(config['image_content_table'])
+    )
+  
+  (
+    images
+      .transform(with_image_info)
+      .write
+      .format('delta')
+      .mode('append')
+      .option('txnAppId', 'cv_images')
+      .option('txnVersion', batch_id)
+      .option('maxRecordsPerFile', 50000) # limit rows written to any one file
+      .partitionBy('date', 'device_id') # allow queries for a device's images to skip those of other devices
+      .saveAsTable(config['input_images_table'])
+    )
+  
+  images.unpersist()
+
+images_stream = (
+  images_with_parsed_data
     .writeStream
-    .format('delta')
-    .outputMode('append')
+    .foreachBatch(persist_images)
     .option('checkpointLocation', config['checkpoint_path'])
-    .trigger(once = True) # feel free to use other triggers to process continuously
-    .partitionBy('date')
-    .table(config['input_images_table'])
+    .trigger(availableNow = True) # process all available data in cycles limited by maxBytesPerTrigger; feel free to use other triggers to process continuously
+    .start()
   )
 
 # COMMAND ----------
 
+# DBTITLE 1,Co-Locate Data for Faster Queries
+# wait for the stream to complete
+images_stream.awaitTermination()
+
+# cluster images by time within each partition and binaries by path for faster joins
+_ = spark.sql(f"OPTIMIZE {config['input_images_table']} ZORDER BY (timestamp)")
+_ = spark.sql(f"OPTIMIZE {config['image_content_table']} ZORDER BY (path)")
+
+# COMMAND ----------
+
 # MAGIC %md ## Appendix: Image Capture Script
 # MAGIC 
 # MAGIC Earlier in this notebook, we expressed our focus was on the processing of images once they arrived in storage.  That said, we know that many folks who read this will be curious how we captured and transmitted the images to the cloud.  The script we used is provided here not to say this is the best way to perform this work in a real-world deployment but instead to provide a starting point for others designing such a routine:
@@ -59,7 +59,7 @@ import io
 
 # MAGIC %md ## Step 1: Access Data
 # MAGIC 
-# MAGIC Our image data resides in a Delta Table named *images*.  The raw binary for each image is available through a field named *content*. The relatively small size of each image along with the small overall number of images in our table would allow us to extract our data to a pandas dataframe against which we could then train our model.  However, we'd like to establish a pattern that would allow our processing to scale, and for that, we'll retrieve our data to a [Petastorm](https://docs.databricks.com/applications/machine-learning/load-data/petastorm.html) cache.
+# MAGIC Our image data resides in a Delta Table named *images*.  The raw binary for each image is available through a field named *content* in a companion table named *image_content* which we join to *images* on each image's *path*. The relatively small size of each image along with the small overall number of images in our table would allow us to extract our data to a pandas dataframe against which we could then train our model.  However, we'd like to establish a pattern that would allow our processing to scale, and for that, we'll retrieve our data to a [Petastorm](https://docs.databricks.com/applications/machine-learning/load-data/petastorm.html) cache.
 # MAGIC 
 # MAGIC Petastorm is a technology available in the Databricks platform which allows us to retrieve data using the distributed power of the cluster and then cache it to Parquet files for fast access by Tensorflow, PyTorch and PySpark.  The caching of data in this manner allows us to train models on volumes of data that might otherwise overwhelm the memory resources available on an individual cluster node.
 # MAGIC 
@@ -74,7 +74,9 @@ import io
 images = (
   spark
     .table(config['input_images_table'])
-    .select('content', 'label', 'path') # path will be used as a unique identifier in next steps
+    .select('label', 'path') # path will be used as a unique identifier in next steps
+    .join(spark.table(config['image_content_table']).select('path', 'content'), on='path') # retrieve image binaries
+    .select('content', 'label', 'path')
   )
 
 # retrieve stratified sample of images
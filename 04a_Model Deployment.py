@@ -308,7 +308,7 @@ personal_access_token = dbutils.notebook.entry_point.getDbutils().notebook().get
 # DBTITLE 1,Retrieve Sample Images
 images = (
   spark
-    .table(config['input_images_table'])
+    .table(config['image_content_table'])
     .select('content')
     .sample(withReplacement=False, fraction=0.01)
     .toPandas()
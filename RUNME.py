@@ -116,7 +116,14 @@ job_json = {
                 "new_cluster": {
                     "spark_version": "12.2.x-cpu-ml-scala2.12",
                 "spark_conf": {
-                    "spark.databricks.delta.formatCheck.enabled": "false"
+                    "spark.databricks.delta.formatCheck.enabled": "false",
+                    "spark.hadoop.fs.s3a.experimental.input.fadvise": "sequential",
+                    "spark.hadoop.fs.s3a.readahead.range": "1M",
+                    "spark.hadoop.fs.s3a.connection.maximum": "200",
+                    "spark.hadoop.fs.s3a.threads.max": "64",
+                    "spark.hadoop.fs.s3a.fast.upload": "true",
+                    "spark.hadoop.fs.s3a.multipart.size": "10M",
+                    "spark.hadoop.fs.azure.read.request.size": "4194304"
                     },
                     "num_workers": 2,
                     "node_type_id": {"AWS": "i3.xlarge", "MSA": "Standard_DS3_v2", "GCP": "n1-highmem-4"},
@@ -130,7 +137,14 @@ job_json = {
                 "new_cluster": {
                     "spark_version": "7.3.x-cpu-ml-scala2.12",
                 "spark_conf": {
-                    "spark.databricks.delta.formatCheck.enabled": "false"
+                    "spark.databricks.delta.formatCheck.enabled": "false",
+                    "spark.hadoop.fs.s3a.experimental.input.fadvise": "sequential",
+                    "spark.hadoop.fs.s3a.readahead.range": "1M",
+                    "spark.hadoop.fs.s3a.connection.maximum": "200",
+                    "spark.hadoop.fs.s3a.threads.max": "64",
+                    "spark.hadoop.fs.s3a.fast.upload": "true",
+                    "spark.hadoop.fs.s3a.multipart.size": "10M",
+                    "spark.hadoop.fs.azure.read.request.size": "4194304"
                     },
                     "num_workers": 2,
                     "node_type_id": {"AWS": "i3.xlarge", "MSA": "Standard_DS3_v2", "GCP": "n1-highmem-4"},